@@ -1,15 +1,50 @@
-import http.server
+import gzip
+import hmac
+import io
 import json
+import logging
 import requests
 import socketserver
+import sys
+import threading
+import time
+import zlib
+from functools import lru_cache
 
 from demoapp.configuredlogger import SeerLogger
+from demoapp.memory import memory_report
+from demoapp.seerpool import SEER_ID_PATTERN
+from demoapp.seerpsyche import Event
 
 log = SeerLogger(__name__, import_level=True)
 
 """The service interface provides access to the application.
 """
 
+DEFAULT_DRAIN_TIMEOUT = 5.0
+
+# Limits on what a client may send. The same limits as http.server.
+MAX_HEADERS = 100
+MAX_LINE_LENGTH = 65536
+MAX_BODY_LENGTH = 65536
+
+# The only request headers that are read. Others are skipped.
+HEADERS_USED = frozenset(
+    (b"accept-encoding", b"authorization", b"content-length")
+)
+
+# Responses smaller than this are not worth compressing.
+COMPRESSION_MIN_SIZE = 1024
+
+# Supported content encodings, in order of preference.
+COMPRESSORS = {
+    "gzip": lambda data: _gzip(data),
+    "deflate": zlib.compress,
+}
+
+# Client addresses that may use the admin endpoints.
+LOCAL_HOSTS = ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
 
 class RestServer:
     """The seer sits in a in a kiosk in a mall waiting all day to share
@@ -26,24 +61,84 @@ class RestServer:
         seer (Seer): The seer provides data for the REST request responses.
         result_queue (collections.deque): A queue used to store the results
             of the request to shut down the HTTP server.
+        threaded (bool): Whether or not to handle each request in its own
+            thread. By default, requests are handled one at a time.
+        profiler (SamplingProfiler): The profiler controlled by the admin
+            endpoints.
+        drain_timeout (float): The number of seconds that requests in flight
+            are given to finish when the server shuts down.
+        pool (SeerPool): The pooled seers, reached at /seers/<id>/.
+        tracer (Tracer): Traces a sample of the REST requests.
+        admin_token (str): The bearer token required by the admin
+            endpoints. Batched events are refused without one.
     """
 
-    def __init__(self, port, seer, result_queue):
+    def __init__(
+        self,
+        port,
+        seer,
+        result_queue,
+        threaded=False,
+        profiler=None,
+        drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+        pool=None,
+        tracer=None,
+        admin_token=None,
+    ):
+        # An empty token, e.g. from DEMOAPP_ADMIN_TOKEN="", is no token.
+        self.admin_token = admin_token or None
         self.port = port
+        self.pool = pool
+        self.profiler = profiler
+        self.tracer = tracer
         self.seer = seer
         self.seer.register_service_interface_shutdown(self.shutdown)
+        self._drain_timeout = drain_timeout
+        self._drained = threading.Event()
         self._result_queue = result_queue
+        self._threaded = threaded
 
     def shutdown(self):
-        """Shutdown the http server to terminate the REST thread."""
+        """Shutdown the http server to terminate the REST thread.
+
+        New connections are refused right away. Requests in flight are
+        given until the drain timeout to finish.
+        """
         log.info("REST server is stopping.")
+        started = time.monotonic()
         try:
-            self._httpd.shutdown()
+            # serve_forever() finishes the request it is handling before
+            # it stops. Don't wait on it for longer than the drain timeout.
+            stopper = threading.Thread(
+                name="REST server stopper",
+                target=self._httpd.shutdown,
+                daemon=True,
+            )
+            stopper.start()
+            stopper.join(self._drain_timeout)
+            if stopper.is_alive():
+                raise TimeoutError("The REST thread did not stop in time.")
+
+            self._httpd.socket.close()
+            remaining = self._drain_timeout - (time.monotonic() - started)
+            if not self._httpd.drain(remaining):
+                raise TimeoutError(
+                    f"{self._httpd.requests_in_flight} requests were "
+                    "still in flight."
+                )
             self._result_queue.append(0)
-            log.debug("Successful shutdown of httpd listener.")
+            log.info(
+                "REST server drained in "
+                f"{time.monotonic() - started:.3f} seconds."
+            )
         except Exception as e:
-            log.error(f"Could not shut down the httpd listener: {e}")
+            log.error(
+                "Could not drain the httpd listener in "
+                f"{time.monotonic() - started:.3f} seconds: {e}"
+            )
             self._result_queue.append(1)
+        finally:
+            self._drained.set()
 
     def listen(self):
         """Open the network based socket and listen for REST requests."""
@@ -52,73 +147,492 @@ class RestServer:
 
         def wrap_handler(*args):
             # Pass the system under test state instance into the handler
-            RestRequestHandler(self.seer, *args)
+            RestRequestHandler(
+                self.seer,
+                *args,
+                profiler=self.profiler,
+                pool=self.pool,
+                tracer=self.tracer,
+                admin_token=self.admin_token,
+            )
 
-        with socketserver.TCPServer(("", self.port), wrap_handler) as httpd:
+        if self._threaded:
+            server_class = DrainableThreadingTCPServer
+        else:
+            server_class = DrainableTCPServer
+
+        with server_class(("", self.port), wrap_handler) as httpd:
             log.debug(f"REST test point listening on port {self.port}")
             self._httpd = httpd
             httpd.serve_forever()
+            # Keep the REST thread, and the app, alive while draining.
+            self._drained.wait()
+
+
+class DrainingMixIn:
+    """Mix-in class to keep track of the requests in flight so that they
+    can be drained at shutdown. It must come before other server classes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # request -> when it was accepted, in nanoseconds since the epoch.
+        self._in_flight = {}
+        self._idle = threading.Condition()
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            self._in_flight[request] = time.time_ns()
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        super().shutdown_request(request)
+        with self._idle:
+            self._in_flight.pop(request, None)
+            if not self._in_flight:
+                self._idle.notify_all()
+
+    def accepted_at(self, request):
+        """When a request in flight was accepted.
 
+        Returns:
+            int: Nanoseconds since the epoch, or None if the request is not
+                in flight.
+        """
+        return self._in_flight.get(request)
+
+    def drain(self, timeout):
+        """Wait for the requests in flight to finish.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
 
-class RestRequestHandler(http.server.SimpleHTTPRequestHandler):
-    """A wrapper handler which intercepts HTTP requests in order to provide a
-    REST interface.
+        Returns:
+            bool: Whether or not all requests finished in time.
+        """
+        with self._idle:
+            return self._idle.wait_for(
+                lambda: not self._in_flight, max(0, timeout)
+            )
+
+    @property
+    def requests_in_flight(self):
+        return len(self._in_flight)
+
+
+class DrainableTCPServer(DrainingMixIn, socketserver.TCPServer):
+    """A TCPServer that can be drained."""
+
+
+class DrainableThreadingTCPServer(
+    DrainingMixIn, socketserver.ThreadingMixIn, socketserver.TCPServer
+):
+    """A TCPServer that can be drained and that handles each request in its
+    own thread.
+    """
+
+    # Draining, not server_close(), decides how long to wait for requests.
+    block_on_close = False
+    daemon_threads = True
+
+
+class RestRequestHandler(socketserver.StreamRequestHandler):
+    """A lean HTTP/1.0 handler which provides a REST interface.
+
+    Only what the REST interface needs is implemented: the request line,
+    the few headers that the endpoints use, and routing through precomputed
+    route tables. Nothing is served from the filesystem. One request is
+    handled per connection.
 
     Args:
         seer (Seer): The seer provides data for the REST request responses.
         *args: (varargs):
-            Arguments to pass along to SimpleHTTPRequestHandler initializer.
+            Arguments to pass along to StreamRequestHandler initializer.
+        profiler (SamplingProfiler): The profiler controlled by the admin
+            endpoints.
+        pool (SeerPool): The pooled seers, reached at /seers/<id>/.
+        tracer (Tracer): Traces a sample of the REST requests.
+        admin_token (str): The bearer token required by the admin
+            endpoints.
     """
 
-    def __init__(self, seer, *args):
+    protocol_version = "HTTP/1.0"
+    server_version = "SeerHTTP/1.0"
+
+    # The trace of this request, if it is sampled.
+    trace = None
+
+    def __init__(
+        self,
+        seer,
+        *args,
+        profiler=None,
+        pool=None,
+        tracer=None,
+        admin_token=None,
+    ):
         # Retrieve the system under test state instance and allow the
         # standard handler to initialize
         self.seer = seer
-        http.server.SimpleHTTPRequestHandler.__init__(self, *args)
+        self.admin_token = admin_token
+        self.pool = pool
+        self.profiler = profiler
+        self.tracer = tracer
+        self.command = None
+        self.headers = {}
+        self.path = None
+        self.requestline = ""
+        socketserver.StreamRequestHandler.__init__(self, *args)
+
+    def handle(self):
+        if self.tracer is not None:
+            accepted_at = self.server.accepted_at(self.request)
+            self.trace = self.tracer.begin("HTTP request", accepted_at)
+            self._mark("accept")
+
+        if self._parse_request():
+            self._mark("parse")
+            self._route()
+
+        if self.trace is not None:
+            self.trace.name = f"{self.command} {self.path}"
+            self.trace.attributes["http.method"] = str(self.command)
+            self.trace.attributes["url.path"] = str(self.path)
+            self.tracer.finish(self.trace)
 
-    def do_GET(self):
-        """Handle REST request routing.
+    def _parse_request(self):
+        """Read the request line and the headers that the endpoints use.
 
-        The default implementation of SimpleHTTPRequestHandler serves static
-        files from the local filesystem.  This method overrides that behavior
-        in order to serve generated JSON responses based on the path requested.
+        Returns:
+            bool: Whether or not the request can be routed. An error
+                response has been sent if it can't.
         """
-        log.debug(f"REST request: {self.path}")
-        if self.path == "/answer":
-            self._endpoint_GET_answer()
-        elif self.path == "/perspective_index":
-            self._endpoint_GET_perspective_index()
-        elif self.path == "/service_state":
-            self._endpoint_GET_service_state()
+        line = self.rfile.readline(MAX_LINE_LENGTH + 1)
+        if not line:
+            # The client went away without asking anything.
+            return False
+        if len(line) > MAX_LINE_LENGTH:
+            self.send_error(
+                requests.codes.request_uri_too_large, "Request line too long"
+            )
+            return False
+
+        self.requestline = line.decode("iso-8859-1").rstrip("\r\n")
+        words = self.requestline.split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            self.send_error(
+                requests.codes.bad_request,
+                f"Bad request line: {self.requestline!r}",
+            )
+            return False
+        self.command, self.path, _ = words
+
+        for _ in range(MAX_HEADERS + 1):
+            line = self.rfile.readline(MAX_LINE_LENGTH + 1)
+            if line in (b"\r\n", b"\n", b""):
+                return True
+            if len(line) > MAX_LINE_LENGTH:
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name in HEADERS_USED:
+                value = value.strip().decode("iso-8859-1")
+                self.headers[name.decode("iso-8859-1")] = value
+
+        self.send_error(
+            requests.codes.header_fields_too_large,
+            "Too many, or too long, headers",
+        )
+        return False
+
+    def _route(self):
+        path = self.path.partition("?")[0]
+        if self.command == "GET":
+            endpoint = self._GET_ROUTES.get(path)
+            if endpoint is not None:
+                endpoint(self, self.seer)
+            elif path in self._PRIMARY_GET_ROUTES:
+                self._PRIMARY_GET_ROUTES[path](self, self.seer)
+            elif path in self._ADMIN_GET_ROUTES:
+                if self._is_admin_allowed():
+                    self._ADMIN_GET_ROUTES[path](self)
+            elif path.startswith("/seers/"):
+                self._route_GET_pooled_seer(path)
+            else:
+                self.send_error(
+                    requests.codes.not_found,
+                    f"Unknown GET endpoint for the seer queries: {path}",
+                )
+        elif self.command == "POST":
+            self._route_POST(path)
         else:
+            self.send_error(
+                requests.codes.not_implemented,
+                f"Unsupported method: {self.command}",
+            )
+
+    def _route_GET_pooled_seer(self, path):
+        # /seers/<id>/<endpoint>
+        if self.pool is None:
+            self.send_error(
+                requests.codes.not_found,
+                "This seer does not share the kiosk.",
+            )
+            return
+
+        seer_id, _, endpoint_path = path[len("/seers/") :].partition("/")
+        endpoint = self._GET_ROUTES.get("/" + endpoint_path)
+        if endpoint is None:
+            self.send_error(
+                requests.codes.not_found,
+                f"Unknown GET endpoint for the seer queries: {path}",
+            )
+            return
+
+        if not SEER_ID_PATTERN.match(seer_id):
+            self.send_error(
+                requests.codes.bad_request, f"Invalid seer id: {seer_id}"
+            )
+            return
+        with self.pool.use(seer_id) as seer:
+            endpoint(self, seer)
+
+    def _route_POST(self, path):
+        # Only administrative operations are POSTed.
+        endpoint = self._POST_ROUTES.get(path)
+        if endpoint is None:
+            self.send_error(
+                requests.codes.not_found,
+                f"Unknown POST endpoint for the seer queries: {path}",
+            )
+        elif self._is_admin_allowed():
+            endpoint(self)
+
+    def _is_admin_allowed(self):
+        """Check that the client may use the admin endpoints.
+
+        Returns:
+            bool: Whether or not the client may. An error response has been
+                sent if it may not.
+        """
+        if self.client_address[0] not in LOCAL_HOSTS:
+            self.send_error(
+                requests.codes.forbidden,
+                "Admin operations are only accepted from the local host.",
+            )
+            return False
+        if not self._is_authorized():
+            self.send_error(
+                requests.codes.unauthorized,
+                "A valid admin token is required.",
+                headers={"WWW-Authenticate": 'Bearer realm="demoapp"'},
+            )
+            return False
+        return True
+
+    def _is_authorized(self):
+        # Without an admin token, the local host check is all there is.
+        if self.admin_token is None:
+            return True
+        scheme, _, token = self.headers.get("authorization", "").partition(
+            " "
+        )
+        return scheme.lower() == "bearer" and hmac.compare_digest(
+            token.strip().encode(), self.admin_token.encode()
+        )
+
+    def _read_json_body(self):
+        """Read and decode the JSON body of the request.
+
+        Returns:
+            object: The decoded body, or None if it could not be read. An
+                error response has been sent if it could not.
+        """
+        try:
+            length = int(self.headers["content-length"])
+        except KeyError:
+            self.send_error(
+                requests.codes.length_required, "Content-Length is required"
+            )
+            return None
+        except ValueError:
+            self.send_error(
+                requests.codes.bad_request, "Content-Length is not a number"
+            )
+            return None
+        if not 0 <= length <= MAX_BODY_LENGTH:
+            self.send_error(
+                requests.codes.request_entity_too_large,
+                f"The body must be at most {MAX_BODY_LENGTH} bytes",
+            )
+            return None
+
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.send_error(
+                requests.codes.bad_request, f"The body is not JSON: {e}"
+            )
+            return None
+
+    def _endpoint_POST_admin_events(self):
+        # Driving the seer is riskier than profiling it. Insist on a token.
+        if self.admin_token is None:
+            self.send_error(
+                requests.codes.forbidden,
+                "The seer was started without an admin token.",
+            )
+            return
+
+        body = self._read_json_body()
+        if body is None:
+            return
+        if not isinstance(body, dict) or not isinstance(
+            body.get("events"), list
+        ):
+            self.send_error(
+                requests.codes.bad_request,
+                'Expected {"events": [...]} with an optional "seer"',
+            )
+            return
+
+        # All of the events are checked before any of them is applied.
+        try:
+            events = [Event(value) for value in body["events"]]
+        except (TypeError, ValueError) as e:
+            self.send_error(requests.codes.bad_request, f"Bad event: {e}")
+            return
+
+        seer_id = body.get("seer")
+        if seer_id is None:
+            self._apply_events(self.seer, events)
+            return
+        if self.pool is None:
             self.send_error(
                 requests.codes.not_found,
-                "Unknown GET endpoint for the seer queries: {self.path}",
+                "This seer does not share the kiosk.",
+            )
+            return
+        seer_id = str(seer_id)
+        if not SEER_ID_PATTERN.match(seer_id):
+            self.send_error(
+                requests.codes.bad_request, f"Invalid seer id: {seer_id}"
             )
+            return
+        # The seer must not be put to rest before the response is sent.
+        with self.pool.use(seer_id) as seer:
+            self._apply_events(seer, events)
 
-    def _endpoint_GET_answer(self):
-        if str(self.seer.state) == "Available":
+    def _apply_events(self, seer, events):
+        seer.apply_events(events)
+        self._send_response_200(
+            {
+                "state": str(seer.state),
+                "perspective": seer.wisdom.perspective,
+                "perspective_index": seer.wisdom.perspective_index,
+            }
+        )
+
+    def _endpoint_POST_admin_profile_start(self):
+        if self.profiler is None:
+            self._send_profiler_unavailable()
+            return
+        self.profiler.start()
+        self._send_response_200({"running": True, "profile": None})
+
+    def _endpoint_POST_admin_profile_stop(self):
+        if self.profiler is None:
+            self._send_profiler_unavailable()
+            return
+        path = self.profiler.stop()
+        self._send_response_200({"running": False, "profile": path})
+
+    def _send_profiler_unavailable(self):
+        self.send_error(
+            requests.codes.service_unavailable,
+            "The seer was started without a profiler.",
+        )
+
+    def _endpoint_GET_answer(self, seer):
+        self._mark("route")
+        if str(seer.state) == "Available":
+            self._mark("state")
             # The seer application only responds in the Available.
-            self._send_response_200(self.seer.wisdom.answer_question())
+            answer = seer.wisdom.encoded_answer()
+            self._mark("sample")
+            self._send_encoded_response_200(answer)
         else:
             self.send_error(
                 requests.codes.service_unavailable,
-                f"The seer is {self.seer.state}. "
+                f"The seer is {seer.state}. "
                 "Please leave a question after the beep.",
             )
 
-    def _endpoint_GET_perspective_index(self):
-        if str(self.seer.state) == "Available":
-            self._send_response_200(self.seer.wisdom.perspective_index)
+    def _endpoint_GET_perspective_index(self, seer):
+        self._mark("route")
+        if str(seer.state) == "Available":
+            self._mark("state")
+            self._send_response_200(seer.wisdom.perspective_index)
         else:
             self.send_error(
                 requests.codes.service_unavailable,
-                f"The seer is {self.seer.state}. "
+                f"The seer is {seer.state}. "
                 "Please leave a question after the beep.",
             )
 
-    def _endpoint_GET_service_state(self):
-        self._send_response_200(str(self.seer.state))
+    def _endpoint_GET_service_state(self, seer):
+        self._mark("route")
+        state = str(seer.state)
+        self._mark("state")
+        self._send_response_200(state)
+
+    def _endpoint_GET_knowledge(self, seer):
+        self._mark("route")
+        # The encoded knowledge, and its compressed forms, only change
+        # when the knowledge does. The store keeps them until then.
+        store = seer.wisdom.knowledge
+        knowledge = store.encoded()
+        self._mark("sample")
+        self._send_encoded_response_200(
+            knowledge,
+            lambda encoding: store.encoded(encoding, COMPRESSORS[encoding]),
+        )
+
+    def _endpoint_GET_debug_transitions(self, seer):
+        self._mark("route")
+        self._send_response_200(seer.transition_stats.as_dict())
+
+    def _endpoint_GET_debug_memory(self):
+        self._mark("route")
+        report = memory_report()
+        if self.pool is not None:
+            report["seers"] = {
+                "incarnated": self.pool.incarnated,
+                "at_rest": len(self.pool) - self.pool.incarnated,
+            }
+        self._send_response_200(report)
+
+    # Path -> endpoint. GET endpoints take the seer being asked. These are
+    # also served for pooled seers at /seers/<id>/.
+    _GET_ROUTES = {
+        "/answer": _endpoint_GET_answer,
+        "/knowledge": _endpoint_GET_knowledge,
+        "/perspective_index": _endpoint_GET_perspective_index,
+        "/service_state": _endpoint_GET_service_state,
+    }
+    # Only the primary seer handles signals, so only it has transitions.
+    _PRIMARY_GET_ROUTES = {
+        "/debug/transitions": _endpoint_GET_debug_transitions,
+    }
+    # Admin endpoints take no seer. They aren't reachable for pooled seers.
+    _ADMIN_GET_ROUTES = {
+        "/debug/memory": _endpoint_GET_debug_memory,
+    }
+    _POST_ROUTES = {
+        "/admin/events": _endpoint_POST_admin_events,
+        "/admin/profile/start": _endpoint_POST_admin_profile_start,
+        "/admin/profile/stop": _endpoint_POST_admin_profile_stop,
+    }
 
     def _send_response_200(self, payload):
         """Send json response for an HTTP Get request
@@ -126,10 +640,152 @@ class RestRequestHandler(http.server.SimpleHTTPRequestHandler):
         Args:
             payload: JSON-serializable data.
         """
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-
         data = json.dumps(payload)
         log.debug(f"REST response: {data}")
-        self.wfile.write(data.encode())
+        encoded = data.encode()
+        self._mark("encode")
+        self._write_response_200(encoded)
+
+    def _send_encoded_response_200(self, data, compressed=None):
+        """Send an already-encoded json response for an HTTP Get request.
+
+        Args:
+            data (bytes): JSON-encoded data.
+            compressed (callable): Gets the data compressed in the given
+                content encoding, e.g. from a cache. By default, the data
+                is compressed when needed.
+        """
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"REST response: {data.decode()}")
+        self._mark("encode")
+        self._write_response_200(data, compressed)
+
+    def _write_response_200(self, data, compressed=None):
+        # Large responses are compressed if the client accepts it.
+        encoding = None
+        compressible = len(data) >= COMPRESSION_MIN_SIZE
+        if compressible:
+            encoding = _choose_encoding(self.headers.get("accept-encoding"))
+        if encoding is not None:
+            if compressed is not None:
+                data = compressed(encoding)
+            else:
+                data = COMPRESSORS[encoding](data)
+            self._mark("compress")
+
+        # The status line, headers and body go out in a single write.
+        self.log_request(200)
+        head = _response_head(
+            self.protocol_version,
+            self.server_version,
+            len(data),
+            encoding,
+            compressible,
+        )
+        self.wfile.write(head + data)
+        self._mark("write")
+
+    def send_error(self, code, message, headers=None):
+        """Send an error response. As with http.server, the message is
+        also the reason phrase of the status line.
+
+        Args:
+            code (int): The HTTP status code.
+            message (str): A description of the error.
+            headers (dict): Additional response headers.
+        """
+        self.log_request(code)
+        reason = " ".join(message.splitlines())
+        body = message.encode()
+        head = (
+            f"{self.protocol_version} {code} {reason}\r\n"
+            f"Server: {self.server_version}\r\n"
+            "Content-Type: text/plain;charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+        )
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        head += "\r\n"
+        self.wfile.write(head.encode("iso-8859-1", "replace") + body)
+
+    def log_request(self, code):
+        """Log an access log line, in the same format as http.server."""
+        if self.trace is not None:
+            self.trace.attributes["http.status_code"] = int(code)
+        sys.stderr.write(
+            f"{self.client_address[0]} - - "
+            f"[{time.strftime('%d/%b/%Y %H:%M:%S')}] "
+            f'"{self.requestline}" {code} -\n'
+        )
+
+    def _mark(self, stage):
+        if self.trace is not None:
+            self.trace.mark(stage)
+
+
+@lru_cache(maxsize=256)
+def _response_head(
+    protocol_version,
+    server_version,
+    content_length,
+    content_encoding=None,
+    vary=False,
+):
+    # Answers come in a handful of lengths. Build each head once.
+    head = (
+        f"{protocol_version} 200 OK\r\n"
+        f"Server: {server_version}\r\n"
+        "Content-type: text/plain\r\n"
+        f"Content-Length: {content_length}\r\n"
+    )
+    if content_encoding is not None:
+        head += f"Content-Encoding: {content_encoding}\r\n"
+    if vary:
+        # Whether or not it was compressed, a cache must not serve this
+        # response to a client that accepts other encodings.
+        head += "Vary: Accept-Encoding\r\n"
+    return (head + "\r\n").encode("latin-1")
+
+
+def _gzip(data):
+    # gzip.compress() only takes an mtime from Python 3.8. A fixed mtime
+    # keeps the output the same for the same data.
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as fp:
+        fp.write(data)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=64)
+def _choose_encoding(accept_encoding):
+    """Choose a content encoding for a response.
+
+    Args:
+        accept_encoding (str): The Accept-Encoding header of the request.
+
+    Returns:
+        str: The most preferred supported encoding, or None if the response
+            should not be compressed.
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    candidates = [
+        (qualities.get(name, qualities.get("*", 0.0)), -rank, name)
+        for rank, name in enumerate(COMPRESSORS)
+    ]
+    quality, _, name = max(candidates)
+    return name if quality > 0 else None
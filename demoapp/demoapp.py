@@ -19,26 +19,93 @@ import sys
 import threading
 from collections import deque
 
-from demoapp.appinterface import RestServer
+from demoapp.appinterface import DEFAULT_DRAIN_TIMEOUT, RestServer
 from demoapp.configuredlogger import SeerLogger
+from demoapp.knowledge import DEFAULT_MAX_SHARDS
+from demoapp.knowledgewatcher import KnowledgeWatcher
+from demoapp.memory import DEFAULT_TRACE_FRAMES, start_tracing
+from demoapp.profiler import SamplingProfiler
+from demoapp.seerpool import DEFAULT_IDLE_TIMEOUT, SeerPool
 from demoapp.seerpsyche import Seer
+from demoapp.tracing import DEFAULT_SAMPLE_RATE, Tracer
 
 log = SeerLogger(__name__, import_level=True)
 
+DEFAULT_PROFILE_DIR = "/tmp/testassitant/profiles"
+
+
+def main(
+    socket_file,
+    rest_port,
+    memories_file,
+    messages_path,
+    knowledge_source=None,
+    watch_interval=None,
+    max_shards=DEFAULT_MAX_SHARDS,
+    threaded_rest=False,
+    profile_dir=DEFAULT_PROFILE_DIR,
+    drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+    pool_size=0,
+    pool_idle_timeout=DEFAULT_IDLE_TIMEOUT,
+    trace_file=None,
+    trace_sample_rate=DEFAULT_SAMPLE_RATE,
+    trace_memory_frames=None,
+    admin_token=None,
+):
+    # Memory is traced from the start, if requested, so that /debug/memory
+    # also sees what the seer learned while waking.
+    if trace_memory_frames:
+        start_tracing(trace_memory_frames)
 
-def main(socket_file, rest_port, memories_file, messages_path):
     # The seer is a stateful object at the core of this application.
     seer = Seer(
         memories_file=memories_file,
         messages_path=messages_path,
         pid=os.getpid(),
         sidecar_socket_file=socket_file,
+        knowledge_source=knowledge_source,
+        max_shards=max_shards,
     )
+
+    # Content updates are picked up without a SIGHUP, if requested.
+    if watch_interval is not None:
+        KnowledgeWatcher(
+            seer.wisdom.knowledge, poll_interval=watch_interval
+        ).start()
+
+    # More seers can share the kiosk, and the knowledge, if requested.
+    pool = None
+    if pool_size:
+        pool = SeerPool(
+            seer.wisdom.knowledge,
+            pid=os.getpid(),
+            max_seers=pool_size,
+            idle_timeout=pool_idle_timeout,
+        )
+
+    # A sample of the REST requests is traced, if requested.
+    tracer = None
+    if trace_file:
+        tracer = Tracer(trace_file, sample_rate=trace_sample_rate)
+        tracer.start()
+
+    # The profiler idles until it is needed.
+    profiler = SamplingProfiler(profile_dir)
+    profiler.register_signal()
+
     # Threads do not have exit values.
     # Use a simple queue to tally errors from within the thread.
     rest_results = deque()
     rest_server = RestServer(
-        port=rest_port, seer=seer, result_queue=rest_results
+        port=rest_port,
+        seer=seer,
+        result_queue=rest_results,
+        threaded=threaded_rest,
+        profiler=profiler,
+        drain_timeout=drain_timeout,
+        pool=pool,
+        tracer=tracer,
+        admin_token=admin_token,
     )
 
     # The REST server is difficult to terminate if in the main thread.
@@ -47,9 +114,18 @@ def main(socket_file, rest_port, memories_file, messages_path):
     )
     rest_thread.setDaemon(True)
     rest_thread.start()
-    rest_thread.join()
+    # A REST thread stuck on a request must not hold up the exit
+    # once the shutdown has given up on draining it.
+    while rest_thread.is_alive() and not rest_results:
+        rest_thread.join(timeout=1)
+    if rest_results:
+        # The seer finishes going to sleep in the seer's event thread.
+        seer.wait_until_asleep()
     log.debug(f"REST thread terminated. {__file__} is exiting")
 
+    if tracer is not None:
+        tracer.stop()
+
     return interpret_rest_result(rest_results)
 
 
@@ -94,6 +170,107 @@ if __name__ == "__main__":
         help="A location for a file that retains the seer's wisdom "
         "across container stop and start operations.",
     )
+    parser.add_argument(
+        "--knowledge",
+        dest="knowledge_source",
+        action="append",
+        default=None,
+        help="A YAML file of perspectives, or a directory of such files, "
+        "for the seer to learn from. May be given more than once. "
+        "The knowledge file packaged with demoapp is used by default.",
+    )
+    parser.add_argument(
+        "--knowledge-cache-shards",
+        dest="max_shards",
+        default=DEFAULT_MAX_SHARDS,
+        type=int,
+        help="The number of knowledge files to keep parsed in memory.",
+    )
+    parser.add_argument(
+        "--watch-knowledge",
+        dest="watch_interval",
+        nargs="?",
+        const=1.0,
+        default=None,
+        type=float,
+        help="Reload changed perspectives when the knowledge file is "
+        "edited. The optional value is the polling interval, in seconds, "
+        "used where inotify is not available.",
+    )
+    parser.add_argument(
+        "--threaded-rest",
+        dest="threaded_rest",
+        action="store_true",
+        help="Handle each REST request in its own thread.",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        dest="profile_dir",
+        default=DEFAULT_PROFILE_DIR,
+        help="Where the sampling profiler writes collapsed-stack profiles. "
+        "The profiler is toggled with SIGRTMIN or with the "
+        "/admin/profile/start and /admin/profile/stop endpoints.",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        dest="drain_timeout",
+        default=DEFAULT_DRAIN_TIMEOUT,
+        type=float,
+        help="At shutdown, the number of seconds that REST requests in "
+        "flight are given to finish. Keep this inside the grace period "
+        "that the container orchestrator allows.",
+    )
+    parser.add_argument(
+        "--seer-pool",
+        dest="pool_size",
+        default=0,
+        type=int,
+        help="Host additional named seers at /seers/<id>/. The value is "
+        "the number of pooled seers to keep in memory. Idle seers beyond "
+        "that are kept as snapshots. Disabled by default.",
+    )
+    parser.add_argument(
+        "--seer-idle-timeout",
+        dest="pool_idle_timeout",
+        default=DEFAULT_IDLE_TIMEOUT,
+        type=float,
+        help="Seconds after which an idle pooled seer is put to rest.",
+    )
+    parser.add_argument(
+        "--trace-file",
+        dest="trace_file",
+        default=None,
+        help="Trace a sample of the REST requests and append the traces, "
+        "in OpenTelemetry JSON, to this file. Disabled by default.",
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        dest="trace_sample_rate",
+        default=DEFAULT_SAMPLE_RATE,
+        type=float,
+        help="The fraction of REST requests to trace, from 0 to 1.",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        dest="trace_memory_frames",
+        nargs="?",
+        const=DEFAULT_TRACE_FRAMES,
+        default=None,
+        type=int,
+        help="Trace memory allocations from startup so that /debug/memory "
+        "reports the top allocation sites. The optional value is the "
+        "number of stack frames recorded per allocation. Tracing slows "
+        "the seer down and is disabled by default.",
+    )
+    parser.add_argument(
+        "--admin-token",
+        dest="admin_token",
+        default=os.environ.get("DEMOAPP_ADMIN_TOKEN"),
+        help="The bearer token that the admin endpoints require, e.g. "
+        "POST /admin/events to apply a batch of seer events. Prefer the "
+        "DEMOAPP_ADMIN_TOKEN environment variable, which is the default, "
+        "as command lines are visible to other processes.",
+    )
     args = parser.parse_args()
 
     # The default path is used here in the mocksystemundertest container
@@ -106,5 +283,17 @@ if __name__ == "__main__":
             args.rest_listener_port,
             args.memories_file,
             messages_path=default_injected_messages_path,
+            knowledge_source=args.knowledge_source,
+            watch_interval=args.watch_interval,
+            max_shards=args.max_shards,
+            threaded_rest=args.threaded_rest,
+            profile_dir=args.profile_dir,
+            drain_timeout=args.drain_timeout,
+            pool_size=args.pool_size,
+            pool_idle_timeout=args.pool_idle_timeout,
+            trace_file=args.trace_file,
+            trace_sample_rate=args.trace_sample_rate,
+            trace_memory_frames=args.trace_memory_frames,
+            admin_token=args.admin_token,
         )
     )
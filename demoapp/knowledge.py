@@ -0,0 +1,550 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import yaml
+from pkg_resources import resource_filename
+
+from demoapp.configuredlogger import SeerLogger
+
+log = SeerLogger(__name__, import_level=True)
+
+"""The fount of knowledge, compiled.
+
+A knowledge file is a YAML list of perspectives. Each perspective has a name
+and a list of answers. The KnowledgeStore compiles knowledge files into
+Perspective objects that are shared, read-only, by whoever asks the seer
+a question.
+
+A file is split into its top-level list items before parsing. Each item is
+fingerprinted and only items whose fingerprint has not been seen before are
+handed to the YAML parser. A reload of a large file in which one perspective
+changed parses one perspective.
+"""
+
+DEFAULT_MAX_SHARDS = 64
+INDEX_FILE = "index.yaml"
+SHARD_SUFFIXES = (".yaml", ".yml")
+
+# A top-level list item starts with a dash in the first column.
+_ITEM_START = re.compile(r"^-(\s|$)")
+
+
+class Perspective:
+    """A named, immutable set of answers.
+
+    Args:
+        name (str): The name of the perspective, e.g. "snarky".
+        answers (iterable): The answers given from this perspective.
+    """
+
+    # There is one Perspective per perspective in the catalog.
+    __slots__ = ("name", "answers", "_encoded_answers")
+
+    def __init__(self, name, answers):
+        self.name = name
+        self.answers = tuple(answers)
+        self._encoded_answers = None
+
+    @property
+    def encoded_answers(self):
+        """tuple: The answers as JSON-encoded bytes, ready to be sent.
+
+        The answers are encoded the first time they are asked for.
+        """
+        if self._encoded_answers is None:
+            self._encoded_answers = tuple(
+                json.dumps(answer).encode() for answer in self.answers
+            )
+        return self._encoded_answers
+
+    def __eq__(self, other):
+        if not isinstance(other, Perspective):
+            return NotImplemented
+        return self.name == other.name and self.answers == other.answers
+
+    def __hash__(self):
+        return hash((self.name, self.answers))
+
+    def __repr__(self):
+        return f"Perspective({self.name!r}, {len(self.answers)} answers)"
+
+
+class KnowledgeDiff:
+    """The differences between two compilations of the knowledge source.
+
+    Args:
+        added (list): Names of perspectives that are new.
+        changed (list): Names of perspectives whose answers changed.
+        removed (list): Names of perspectives that no longer exist.
+    """
+
+    def __init__(self, added=(), changed=(), removed=()):
+        self.added = list(added)
+        self.changed = list(changed)
+        self.removed = list(removed)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self):
+        return (
+            f"added={self.added}, changed={self.changed}, "
+            f"removed={self.removed}"
+        )
+
+
+class Shard:
+    """The compiled contents of one shard of the knowledge source.
+
+    Args:
+        path (str): The file the shard was compiled from.
+        perspectives (tuple): The Perspective objects in the shard.
+        compiled_items (dict): Perspective objects keyed by the fingerprint
+            of the text they were compiled from. Used to recompile the
+            shard incrementally.
+    """
+
+    def __init__(self, path, perspectives, compiled_items):
+        self.path = path
+        self.perspectives = {p.name: p for p in perspectives}
+        self.compiled_items = compiled_items
+
+    def perspective(self, name):
+        try:
+            return self.perspectives[name]
+        except KeyError:
+            raise ValueError(
+                f"The index says perspective {name} is in {self.path}, "
+                "but it is not."
+            )
+
+
+class ShardCache:
+    """A least-recently-used cache of compiled shards.
+
+    Args:
+        max_shards (int): The number of shards to keep compiled. The least
+            recently used shard is forgotten to make room for another.
+    """
+
+    def __init__(self, max_shards=DEFAULT_MAX_SHARDS):
+        self.max_shards = max(1, max_shards)
+        self._shards = OrderedDict()
+
+    def get(self, path):
+        shard = self._shards.get(path)
+        if shard is not None:
+            self._shards.move_to_end(path)
+        return shard
+
+    def put(self, path, shard):
+        self._shards[path] = shard
+        self._shards.move_to_end(path)
+        while len(self._shards) > self.max_shards:
+            evicted, _ = self._shards.popitem(last=False)
+            log.debug(f"Forgot knowledge shard {evicted}.")
+
+    def pop(self, path):
+        return self._shards.pop(path, None)
+
+    def paths(self):
+        return list(self._shards)
+
+    def __len__(self):
+        return len(self._shards)
+
+
+class KnowledgeStore:
+    """The compiled form of the knowledge source.
+
+    The knowledge source is one or more shards. A shard is a knowledge file
+    holding one perspective or a group of them. Only the shard index, i.e.
+    which perspective lives in which shard, is built up front. A shard is
+    compiled the first time one of its perspectives is selected and is kept
+    in a ShardCache so that memory stays bounded for large catalogs.
+
+    The index is found like so:
+    * A file source is one shard. It is compiled to find its perspective
+      names, which are kept until the file changes.
+    * A directory source with an index.yaml file uses it. The index maps
+      shard file names to lists of perspective names.
+    * Otherwise, each .yaml file in a directory source is a shard holding
+      the one perspective named after the file, e.g. snarky.yaml.
+
+    The store is read-only to its readers. A refresh builds a new index and
+    recompiles changed shards off to the side, then swaps them in. Readers
+    that already hold a Perspective keep using it until they notice that
+    the generation number has moved on.
+
+    Args:
+        source (str or list): A knowledge file, a directory of shards, or a
+            list of either. The knowledge file included in this module's
+            package is used by default.
+        max_shards (int): The number of compiled shards to keep in memory.
+    """
+
+    def __init__(self, source=None, max_shards=DEFAULT_MAX_SHARDS):
+        if source is None:
+            source = resource_filename("demoapp", "data/knowledge.yaml")
+        if isinstance(source, (str, os.PathLike)):
+            source = [source]
+        self._sources = tuple(os.fspath(s) for s in source)
+        self._cache = ShardCache(max_shards)
+        self._encoded = (None, {})
+        self._fingerprints = {}
+        # File source -> (fingerprint, perspective names).
+        self._file_index = {}
+        self._lock = threading.RLock()
+        self.generation = 0
+        # (perspective name, shard path) for each perspective.
+        self.index = ()
+
+    def refresh(self):
+        """Rebuild the shard index and recompile compiled shards that
+        changed. Shards that are not compiled stay that way.
+
+        Returns:
+            KnowledgeDiff: What changed relative to the previous refresh.
+                Changed perspectives are only known for compiled shards.
+                The generation number moves when any shard changed,
+                including the order of the perspectives.
+
+        Raises:
+            ValueError: If the knowledge has no perspectives. The store is
+                left as it was.
+        """
+        with self._lock:
+            index, file_index, file_shards = self._build_index()
+            fingerprints = {
+                path: _fingerprint(path) for _, path in index
+            }
+
+            stale = [
+                path
+                for path, fingerprint in fingerprints.items()
+                if self._fingerprints.get(path) != fingerprint
+            ]
+            # Compile off to the side. Nothing is swapped in until the
+            # index is known to be good. Only shards that were compiled
+            # before are kept compiled.
+            compiled = {}
+            for path in stale:
+                previous = self._cache.get(path)
+                if previous is None:
+                    continue
+                compiled[path] = file_shards.get(path) or self._compile_shard(
+                    path, previous
+                )
+            shards = {
+                path: self._cache.get(path) for path in self._cache.paths()
+            }
+            shards.update(compiled)
+            index = _verified(index, shards)
+            if not index:
+                # Most likely an edit in progress.
+                raise ValueError("The knowledge has no perspectives.")
+            diff = _diff_index(self.index, index)
+
+            for path, shard in compiled.items():
+                previous = self._cache.pop(path)
+                self._cache.put(path, shard)
+                if previous is None or previous is shard:
+                    continue
+                diff.changed.extend(
+                    name
+                    for name, p in shard.perspectives.items()
+                    if name in previous.perspectives
+                    and previous.perspectives[name] != p
+                )
+            for path in self._cache.paths():
+                if path not in fingerprints:
+                    self._cache.pop(path)
+
+            if stale or index != self.index:
+                self.index = index
+                self._fingerprints = fingerprints
+                self._file_index = file_index
+                self.generation += 1
+                log.debug(
+                    f"Knowledge generation {self.generation} indexed "
+                    f"{len(index)} perspectives: {diff}"
+                )
+            return diff
+
+    def index_of(self, name):
+        """Find a perspective by name.
+
+        Returns:
+            int: The perspective index, or None if there is no such
+                perspective.
+        """
+        for idx, (perspective_name, _) in enumerate(self.index):
+            if perspective_name == name:
+                return idx
+        return None
+
+    def _build_index(self):
+        """Build the shard index.
+
+        Returns:
+            tuple: The index, the perspective names of the file sources,
+                and the shards compiled to find them, keyed by their paths.
+        """
+        index = []
+        file_index = {}
+        file_shards = {}
+        for source in self._sources:
+            if os.path.isdir(source):
+                index.extend(_index_directory(source))
+                continue
+
+            # A knowledge file is one shard. Its perspective names are only
+            # known for sure once it is compiled, so they are kept until
+            # the file changes. Unchanged items aren't parsed again.
+            fingerprint = _fingerprint(source)
+            known = self._file_index.get(source)
+            if known is None or known[0] != fingerprint:
+                shard = self._compile_shard(source, self._cache.get(source))
+                file_shards[source] = shard
+                known = (fingerprint, tuple(shard.perspectives))
+            file_index[source] = known
+            index.extend((name, source) for name in known[1])
+
+        seen = set()
+        for name, path in index:
+            if name in seen:
+                log.warning(f"Perspective {name} in {path} is a duplicate.")
+            seen.add(name)
+        return tuple(index), file_index, file_shards
+
+    def _shard(self, path):
+        with self._lock:
+            shard = self._cache.get(path)
+            if shard is None:
+                shard = self._compile_shard(path)
+                self._cache.put(path, shard)
+                self._drop_missing({path: shard})
+            return shard
+
+    def _compile_shard(self, path, previous=None):
+        with open(path, "r", encoding="utf-8") as fp:
+            text = fp.read()
+        compiled_items = previous.compiled_items if previous else {}
+        perspectives, compiled_items = _compile(text, compiled_items)
+        log.debug(f"Compiled knowledge shard {path}.")
+        return Shard(path, perspectives, compiled_items)
+
+    def encoded(self, encoding=None, compress=None):
+        """All of the knowledge, JSON-encoded, as a list of perspectives
+        with their answers.
+
+        Shards that are not compiled are compiled for the encoding only.
+        They are not kept in the ShardCache, where they would push out
+        the shards that seers are using.
+
+        Args:
+            encoding (str): A content encoding, e.g. "gzip", in which to
+                get the encoded knowledge. By default, it isn't compressed.
+            compress (callable): Compresses bytes in that encoding.
+
+        Returns:
+            bytes: The encoded knowledge. The same object is returned until
+                the generation number moves on. Only the forms of the
+                current generation are kept.
+        """
+        with self._lock:
+            generation, forms = self._encoded
+            if generation != self.generation:
+                forms = {None: self._encode()}
+                # Encoding may have dropped missing perspectives.
+                self._encoded = (self.generation, forms)
+            if encoding not in forms:
+                forms[encoding] = compress(forms[None])
+            return forms[encoding]
+
+    def _encode(self):
+        shards = {}
+        for _, path in self.index:
+            if path not in shards:
+                shards[path] = self._cache.get(path) or self._compile_shard(
+                    path
+                )
+        self._drop_missing(shards)
+
+        knowledge = []
+        for name, path in self.index:
+            answers = list(shards[path].perspectives[name].answers)
+            knowledge.append({"perspective": name, "answers": answers})
+        return json.dumps(knowledge).encode()
+
+    def _drop_missing(self, shards):
+        # Drop perspectives that the compiled shards don't actually hold.
+        index = _verified(self.index, shards)
+        if index != self.index:
+            # Readers notice the generation and move on to perspectives
+            # that exist.
+            self.index = index
+            self.generation += 1
+
+    @property
+    def paths(self):
+        """The files and directories the store is compiled from."""
+        return self._sources
+
+    @property
+    def max_shards(self):
+        """int: The number of compiled shards kept in memory."""
+        return self._cache.max_shards
+
+    def __getitem__(self, idx):
+        name, path = self.index[idx]
+        return self._shard(path).perspective(name)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # Locks can't be pickled and compiled shards are a cache.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_cache"] = ShardCache(self._cache.max_shards)
+        state["_encoded"] = (None, {})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+def _compile(text, compiled_items):
+    """Compile the text of a knowledge file into perspectives.
+
+    Args:
+        text (str): The YAML text.
+        compiled_items (dict): Perspectives compiled earlier, keyed by the
+            fingerprint of their text. These are not parsed again.
+
+    Returns:
+        tuple: The perspectives and the new compiled items.
+    """
+    items = _split_items(text)
+    if items is None:
+        # Not a simple block-style list. Parse the whole thing.
+        log.debug("Knowledge is not a block list. Parsing all of it.")
+        return _compile_whole(text), {}
+
+    new_items = {}
+    perspectives = []
+    parsed = 0
+    for item in items:
+        digest = hashlib.sha1(item.encode()).digest()
+        perspective = compiled_items.get(digest)
+        if perspective is None:
+            try:
+                raw = yaml.load(item, Loader=yaml.SafeLoader)
+            except yaml.YAMLError as e:
+                # E.g. an alias of an anchor in another item.
+                log.debug(f"Knowledge items can't be parsed alone: {e}")
+                return _compile_whole(text), {}
+            perspective = _to_perspective(raw[0])
+            parsed += 1
+        new_items[digest] = perspective
+        perspectives.append(perspective)
+
+    log.debug(f"Parsed {parsed} of {len(items)} perspectives.")
+    # Items that are no longer in the text are forgotten.
+    return tuple(perspectives), new_items
+
+
+def _compile_whole(text):
+    return tuple(
+        _to_perspective(raw)
+        for raw in yaml.load(text, Loader=yaml.SafeLoader) or []
+    )
+
+
+def _index_directory(directory):
+    index_file = os.path.join(directory, INDEX_FILE)
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as fp:
+            shard_index = yaml.load(fp, Loader=yaml.SafeLoader) or {}
+        return [
+            (name, os.path.join(directory, shard))
+            for shard, names in shard_index.items()
+            for name in names
+        ]
+
+    return [
+        (os.path.splitext(entry)[0], os.path.join(directory, entry))
+        for entry in sorted(os.listdir(directory))
+        if entry.endswith(SHARD_SUFFIXES) and entry != INDEX_FILE
+    ]
+
+
+def _fingerprint(path):
+    try:
+        st = os.stat(path)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+
+def _split_items(text):
+    """Split a block-style YAML list into the text of its items.
+
+    Returns:
+        list: One string per list item, or None if the text is not a
+            block-style list that can be split safely.
+    """
+    items = []
+    current = None
+    for line in text.splitlines(keepends=True):
+        if _ITEM_START.match(line):
+            current = [line]
+            items.append(current)
+        elif current is not None:
+            current.append(line)
+        elif line.strip() and not line.lstrip().startswith(("#", "---")):
+            # Content before the first item. Let the parser sort it out.
+            return None
+    return ["".join(item) for item in items]
+
+
+def _to_perspective(raw):
+    try:
+        return Perspective(raw["perspective"], raw["answers"])
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed perspective in knowledge: {e}")
+
+
+def _verified(index, shards):
+    """Drop the index entries of perspectives that the given, compiled,
+    shards don't hold, e.g. snarky.yaml holding perspective "snark".
+
+    Returns:
+        tuple: The index, without the missing perspectives.
+    """
+    verified = []
+    for name, path in index:
+        shard = shards.get(path)
+        if shard is not None and name not in shard.perspectives:
+            log.error(
+                f"The index says perspective {name} is in {path}, but it "
+                "is not. The perspective is ignored."
+            )
+            continue
+        verified.append((name, path))
+    return tuple(verified)
+
+
+def _diff_index(old, new):
+    old_names = {name for name, _ in old}
+    new_names = {name for name, _ in new}
+    return KnowledgeDiff(
+        added=[name for name, _ in new if name not in old_names],
+        removed=[name for name, _ in old if name not in new_names],
+    )
@@ -0,0 +1,208 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from demoapp.configuredlogger import SeerLogger
+from demoapp.knowledge import SHARD_SUFFIXES
+
+log = SeerLogger(__name__, import_level=True)
+
+"""Hot reloading of the fount of knowledge.
+
+Content teams edit knowledge files while the seer is running. The
+KnowledgeWatcher notices the edit and asks the KnowledgeStore to refresh
+itself. The store only re-parses the perspectives that changed and swaps
+them in without disturbing questions that are already being answered.
+
+On Linux the watcher uses inotify. Anywhere else, or if inotify is not
+available, the watcher falls back to polling os.stat().
+"""
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+_SHARD_SUFFIXES = tuple(os.fsencode(suffix) for suffix in SHARD_SUFFIXES)
+
+
+class KnowledgeWatcher:
+    """Watches the files behind a KnowledgeStore and refreshes the store
+    when one of them changes.
+
+    Args:
+        knowledge (KnowledgeStore): The store to keep up to date.
+        poll_interval (float): Seconds between checks when polling. This is
+            also how long editors get to finish writing before a refresh.
+        use_inotify (bool): Whether or not to try inotify before falling
+            back to polling.
+    """
+
+    def __init__(self, knowledge, poll_interval=1.0, use_inotify=True):
+        self._knowledge = knowledge
+        self._poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self._backend = None
+        if use_inotify:
+            try:
+                self._backend = _InotifyBackend(knowledge.paths)
+            except OSError as e:
+                log.info(f"inotify is unavailable, polling instead: {e}")
+        if self._backend is None:
+            self._backend = _PollingBackend(knowledge.paths)
+
+    def start(self):
+        """Start watching in a daemon thread."""
+        self._thread = threading.Thread(
+            name="Knowledge watcher", target=self._watch, daemon=True
+        )
+        self._thread.start()
+        log.info(
+            f"Watching knowledge with {self._backend.name}: "
+            f"{', '.join(self._knowledge.paths)}"
+        )
+
+    def stop(self):
+        """Stop watching and wait for the watcher thread to finish."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._backend.close()
+
+    def _watch(self):
+        while not self._stopping.is_set():
+            if not self._backend.wait_for_change(self._poll_interval):
+                continue
+
+            # Editors tend to write in several steps. Let them finish.
+            self._stopping.wait(self._poll_interval / 4)
+            self._backend.wait_for_change(0)
+            try:
+                diff = self._knowledge.refresh()
+            except Exception as e:
+                # A half-finished edit. The next change will try again.
+                log.error(f"Could not reload knowledge: {e}")
+                continue
+
+            if diff:
+                log.info(f"Knowledge reloaded: {diff}")
+            else:
+                log.debug("Knowledge touched but unchanged.")
+
+
+class _PollingBackend:
+    name = "stat polling"
+
+    def __init__(self, paths):
+        self._paths = tuple(paths)
+        self._fingerprints = self._fingerprint()
+
+    def wait_for_change(self, timeout):
+        if timeout:
+            time.sleep(timeout)
+        fingerprints = self._fingerprint()
+        changed = fingerprints != self._fingerprints
+        self._fingerprints = fingerprints
+        return changed
+
+    def close(self):
+        pass
+
+    def _fingerprint(self):
+        fingerprints = []
+        for path in self._paths:
+            if os.path.isdir(path):
+                fingerprints.extend(
+                    _stat(os.path.join(path, entry))
+                    for entry in sorted(os.listdir(path))
+                    if entry.endswith(SHARD_SUFFIXES)
+                )
+            else:
+                fingerprints.append(_stat(path))
+        return fingerprints
+
+
+class _InotifyBackend:
+    name = "inotify"
+
+    # Directories are watched rather than files. Editors and deployment
+    # tools often replace a file instead of writing to it.
+    _MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("libc has no inotify support")
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # Watch descriptor -> names of the watched files in that directory.
+        # None stands for any knowledge file in the directory.
+        self._watched = {}
+        for path in paths:
+            if os.path.isdir(path):
+                directory, name = os.path.abspath(path), None
+            else:
+                directory, name = os.path.split(os.path.abspath(path))
+            wd = libc.inotify_add_watch(
+                self._fd, os.fsencode(directory), self._MASK
+            )
+            if wd < 0:
+                os.close(self._fd)
+                raise OSError(
+                    ctypes.get_errno(), f"Can't watch {directory}"
+                )
+            self._watched.setdefault(wd, set()).add(
+                name if name is None else os.fsencode(name)
+            )
+
+    def wait_for_change(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+
+        changed = False
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(buffer):
+                wd, _, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = buffer[offset : offset + length].rstrip(b"\0")
+                offset += length
+                names = self._watched.get(wd, ())
+                if name in names:
+                    changed = True
+                elif None in names and name.endswith(_SHARD_SUFFIXES):
+                    changed = True
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return path, st.st_ino, st.st_size, st.st_mtime_ns
+    except OSError:
+        return path, None
@@ -0,0 +1,97 @@
+import os
+import resource
+import tracemalloc
+
+from demoapp.configuredlogger import SeerLogger
+
+log = SeerLogger(__name__, import_level=True)
+
+"""How much memory does a seer need?
+
+Containers are packed by their memory limits, so the seer's resident set
+size (RSS) has to be predictable. The memory report shows the RSS of the
+process and, if memory tracing was started, the source lines that hold the
+most memory.
+
+Tracing is off by default. It slows down every allocation and costs memory
+of its own, so it is only started on request, at startup, so that the
+allocations made while the knowledge is compiled are seen too.
+"""
+
+DEFAULT_TRACE_FRAMES = 1
+DEFAULT_TOP_SITES = 20
+
+# Allocations made by the tracing machinery itself are not interesting.
+_TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def start_tracing(frames=DEFAULT_TRACE_FRAMES):
+    """Start tracing memory allocations.
+
+    Args:
+        frames (int): The number of stack frames recorded per allocation.
+    """
+    tracemalloc.start(frames)
+    log.info(f"Tracing memory allocations, {frames} frame(s) deep.")
+
+
+def memory_report(limit=DEFAULT_TOP_SITES):
+    """Report the memory usage of the process.
+
+    Args:
+        limit (int): The number of allocation sites to report.
+
+    Returns:
+        dict: The resident set size, current and peak, in bytes. If memory
+            is being traced, also the traced memory and the allocation
+            sites holding the most memory, largest first.
+    """
+    rss, peak_rss = _rss()
+    report = {
+        "rss": rss,
+        "peak_rss": peak_rss,
+        "tracing": tracemalloc.is_tracing(),
+    }
+    if not report["tracing"]:
+        return report
+
+    traced, peak_traced = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+    report["traced"] = traced
+    report["peak_traced"] = peak_traced
+    report["top"] = []
+    for stat in snapshot.statistics("lineno")[:limit]:
+        frame = stat.traceback[0]
+        report["top"].append(
+            {
+                "site": f"{frame.filename}:{frame.lineno}",
+                "size": stat.size,
+                "count": stat.count,
+            }
+        )
+    return report
+
+
+def _rss():
+    # /proc has the current RSS. getrusage() only knows the peak.
+    rss = peak_rss = None
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak_rss = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if peak_rss is None:
+        # Kilobytes on Linux, bytes on macOS.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if os.uname().sysname != "Darwin":
+            peak_rss *= 1024
+    return rss, peak_rss
@@ -0,0 +1,157 @@
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from demoapp.configuredlogger import SeerLogger
+
+log = SeerLogger(__name__, import_level=True)
+
+"""A profiler for a seer that can't be taken off the kiosk.
+
+A debugger can't be attached to PID 1 in a running container. Instead, the
+SamplingProfiler is built in and idles until it is turned on, either by a
+signal or by a request to the admin endpoint of the REST interface.
+
+While running, the profiler wakes up every few milliseconds and records
+the call stack of every other thread. That includes the REST thread and the
+seer's event thread, where signals are turned into state transitions.
+Stopping the profiler writes the samples as collapsed stacks, one line per
+unique stack, that flamegraph.pl, speedscope and friends can render.
+"""
+
+DEFAULT_PROFILE_SIGNAL = getattr(signal, "SIGRTMIN", signal.SIGPROF)
+
+
+class SamplingProfiler:
+    """Samples the call stacks of the application's threads.
+
+    Args:
+        output_dir (str): The directory in which to write profiles.
+        interval (float): Seconds between samples.
+    """
+
+    def __init__(self, output_dir, interval=0.005):
+        self._output_dir = output_dir
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._toggle_lock = threading.Lock()
+        self._samples = Counter()
+        self._started_at = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling. Starting a running profiler does nothing.
+
+        Returns:
+            bool: Whether or not the profiler was started by this call.
+        """
+        with self._lock:
+            if self.is_running:
+                return False
+            self._samples = Counter()
+            self._started_at = time.time()
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                name="Sampling profiler", target=self._sample, daemon=True
+            )
+            self._thread.start()
+        log.info("Sampling profiler started.")
+        return True
+
+    def stop(self):
+        """Stop sampling and write the profile.
+
+        Returns:
+            str: The path of the profile, or None if the profiler was not
+                running or the profile could not be written.
+        """
+        with self._lock:
+            if not self.is_running:
+                return None
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+            return self._dump()
+
+    def toggle(self):
+        """Stop the profiler if it is running. Otherwise, start it."""
+        with self._toggle_lock:
+            if self.is_running:
+                self.stop()
+            else:
+                self.start()
+
+    def register_signal(self, sig=DEFAULT_PROFILE_SIGNAL):
+        """Toggle the profiler when the designated signal is received.
+
+        Args:
+            sig (signal.Signals): An otherwise unused signal.
+        """
+        signal.signal(sig, self._handle_profile_signal)
+        log.debug(
+            f"Registered signal {sig.name} ({sig.value}) "
+            f"to handler: {self._handle_profile_signal.__name__}"
+        )
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _handle_profile_signal(self, signum, sigstack):
+        # Writing the profile must not happen in the main thread, where an
+        # error would take the whole process down.
+        threading.Thread(
+            name="Profiler toggle", target=self.toggle, daemon=True
+        ).start()
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stopping.wait(self._interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread_name = names.get(ident, ident)
+                self._samples[(thread_name, _collapse(frame))] += 1
+
+    def _dump(self):
+        started_at = time.gmtime(self._started_at)
+        stamp = time.strftime("%Y%m%d-%H%M%S", started_at)
+        name = f"demoapp-{os.getpid()}-{stamp}.folded"
+        samples = self._samples.most_common()
+        total = sum(self._samples.values())
+
+        # Don't lose the samples to a bad output directory.
+        for output_dir in (self._output_dir, tempfile.gettempdir()):
+            path = os.path.join(output_dir, name)
+            try:
+                os.makedirs(output_dir, exist_ok=True)
+                with open(path, "w") as fp:
+                    for (thread_name, stack), count in samples:
+                        fp.write(f"{thread_name};{stack} {count}\n")
+            except OSError as e:
+                log.error(f"Could not write the profile to {path}: {e}")
+                continue
+            log.info(f"Sampling profiler stopped. {total} samples in {path}")
+            return path
+
+        log.error(f"Sampling profiler stopped. {total} samples were lost.")
+        return None
+
+
+def _collapse(frame):
+    # Outermost frame first, as flame graph tools expect.
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}"
+            f":{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(stack))
@@ -0,0 +1,176 @@
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from demoapp.configuredlogger import SeerLogger
+from demoapp.seerpsyche import Event, Seer
+from demoapp.sidecarinterface import QuietNotifier
+from demoapp.wisdom import Wisdom
+
+log = SeerLogger(__name__, import_level=True)
+
+"""Many seers, one kiosk.
+
+A SeerPool hosts any number of named seers in one process. Each seer has its
+own perspective and its own state machine, but they all learn from the same
+compiled knowledge. A seer is incarnated the first time it is asked about.
+Seers that have been idle for a while are put to rest as a snapshot of their
+state and perspective, and are incarnated again from it when needed. Seers
+that have rested for longest are eventually forgotten altogether.
+
+Pooled seers don't talk to the sidecar and don't handle signals. Those
+belong to the primary seer of the process.
+"""
+
+DEFAULT_MAX_SEERS = 256
+DEFAULT_IDLE_TIMEOUT = 300.0
+DEFAULT_MAX_SNAPSHOTS = 10000
+
+# Seer ids appear in URLs.
+SEER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+# The events that return a freshly incarnated, Available, seer to the state
+# it was in when it was put to rest.
+_RESTORING_EVENTS = {
+    "Available": (),
+    "Napping": (Event.overexert,),
+    "Sleeping": (Event.sleep,),
+    "Waking": (Event.overexert, Event.awaken),
+}
+
+
+class SeerSnapshot:
+    """What is left of a seer that was put to rest.
+
+    Args:
+        state (str): The name of the seer's state, e.g. "Napping".
+        perspective (str): The name of the seer's perspective.
+    """
+
+    __slots__ = ("state", "perspective")
+
+    def __init__(self, state, perspective):
+        self.state = state
+        self.perspective = perspective
+
+    def __repr__(self):
+        return f"SeerSnapshot({self.state!r}, {self.perspective!r})"
+
+
+class SeerPool:
+    """Hosts named seers that share compiled knowledge.
+
+    Args:
+        knowledge (KnowledgeStore): The compiled knowledge shared by all of
+            the seers. It must already have been acquired.
+        pid (int): The PID that the seers report.
+        max_seers (int): The number of seers to keep incarnated. The least
+            recently asked seer is put to rest to make room for another.
+        idle_timeout (float): Seconds after which an idle seer is put
+            to rest.
+        max_snapshots (int): The number of seers to keep at rest. The seer
+            that has rested longest is forgotten to make room for another.
+    """
+
+    def __init__(
+        self,
+        knowledge,
+        pid,
+        max_seers=DEFAULT_MAX_SEERS,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        max_snapshots=DEFAULT_MAX_SNAPSHOTS,
+    ):
+        self._knowledge = knowledge
+        self._pid = pid
+        self._max_seers = max(1, max_seers)
+        self._idle_timeout = idle_timeout
+        self._max_snapshots = max(0, max_snapshots)
+        self._lock = threading.Lock()
+        # seer id -> (seer, time last asked), least recently asked first.
+        self._seers = OrderedDict()
+        # seer id -> SeerSnapshot, longest at rest first.
+        self._snapshots = OrderedDict()
+        # seer id -> the number of requests using the seer. Seers in use
+        # are not put to rest.
+        self._in_use = Counter()
+
+    @contextmanager
+    def use(self, seer_id):
+        """Find, or incarnate, the named seer and keep it incarnated while
+        it is in use.
+
+        Args:
+            seer_id (str): The name of the seer. See SEER_ID_PATTERN.
+
+        Yields:
+            Seer: The seer.
+
+        Raises:
+            ValueError: If the seer id is not valid.
+        """
+        if not SEER_ID_PATTERN.match(seer_id):
+            raise ValueError(f"Invalid seer id: {seer_id}")
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seers.pop(seer_id, None)
+            seer = self._incarnate(seer_id) if entry is None else entry[0]
+            self._seers[seer_id] = (seer, now)
+            self._in_use[seer_id] += 1
+            self._put_idle_seers_to_rest(now)
+        try:
+            yield seer
+        finally:
+            with self._lock:
+                self._in_use[seer_id] -= 1
+                if not self._in_use[seer_id]:
+                    del self._in_use[seer_id]
+                # Seers spared while in use may be put to rest now.
+                self._put_idle_seers_to_rest(time.monotonic())
+
+    def _incarnate(self, seer_id):
+        snapshot = self._snapshots.pop(seer_id, None)
+        wisdom = Wisdom(knowledge=self._knowledge)
+        wisdom.recall_perspective(snapshot.perspective if snapshot else None)
+        seer = Seer(
+            memories_file=None,
+            messages_path=None,
+            pid=self._pid,
+            sidecar_socket_file=None,
+            wisdom=wisdom,
+            notifier=QuietNotifier(),
+            handle_signals=False,
+        )
+        if snapshot is not None:
+            for event in _RESTORING_EVENTS[snapshot.state]:
+                seer.event(event)
+        log.debug(f"Seer {seer_id} incarnated from {snapshot}.")
+        return seer
+
+    def _put_idle_seers_to_rest(self, now):
+        # The least recently asked seers are first in line.
+        for seer_id, (seer, last_asked) in list(self._seers.items()):
+            idle = now - last_asked > self._idle_timeout
+            if not idle and len(self._seers) <= self._max_seers:
+                break
+            if seer_id in self._in_use:
+                continue
+            del self._seers[seer_id]
+            self._snapshots[seer_id] = SeerSnapshot(
+                str(seer.state), seer.wisdom.perspective
+            )
+            log.debug(f"Seer {seer_id} put to rest.")
+
+        while len(self._snapshots) > self._max_snapshots:
+            seer_id, _ = self._snapshots.popitem(last=False)
+            log.debug(f"Seer {seer_id} forgotten.")
+
+    @property
+    def incarnated(self):
+        """int: The number of seers that are not at rest."""
+        return len(self._seers)
+
+    def __len__(self):
+        return len(self._seers) + len(self._snapshots)
@@ -1,9 +1,13 @@
 import os
 import pickle
+import queue
 import signal
+import threading
+import time
 from enum import Enum
 
 from demoapp.configuredlogger import SeerLogger
+from demoapp.knowledge import DEFAULT_MAX_SHARDS
 from demoapp.sidecarinterface import SidecarNotifier
 from demoapp.wisdom import Wisdom
 
@@ -39,8 +43,16 @@ sig_num_to_name = {
     signal.SIGINT.value: "SIGINT",
     signal.SIGUSR1.value: "SIGUSR1",
     signal.SIGUSR2.value: "SIGUSR2",
+    signal.SIGTERM.value: "SIGTERM",
 }
 
+# Signals beyond this many waiting to be processed are dropped. SIGTERM
+# is always queued.
+DEFAULT_EVENT_QUEUE_SIZE = 64
+
+# Queued in place of an Event to shut the seer down.
+_SHUTDOWN = "shutdown"
+
 
 class Seer:
     """The Seer ia all-seeing and all-knowing, NOT.
@@ -59,23 +71,60 @@ class Seer:
             (SUT) container. This app sends status updates over the socket.
         pid (int): In normal use, the PID is 1 in a Docker container.
             In unit testing, the PID varies.
+        knowledge_source (str or list): The knowledge files or directories
+            the seer learns from. See Wisdom.
+        max_shards (int): The number of knowledge shards to keep compiled.
+        wisdom (Wisdom): Wisdom for the seer to start with, instead of
+            memories or book knowledge.
+        notifier (SidecarNotifier): Where the seer sends notifications.
+            By default, notifications go to the sidecar socket.
+        handle_signals (bool): Whether or not the seer handles O/S signals.
+            Only one seer in a process can. Signals are queued by the
+            signal handlers and processed in order by an event thread.
+            Repeats of the same event in the queue are processed once.
+        event_queue_size (int): The number of signals that may wait to be
+            processed. Signals beyond that, except SIGTERM, are
+            dropped.
     """
 
-    def __init__(self, memories_file, messages_path, pid, sidecar_socket_file):
+    def __init__(
+        self,
+        memories_file,
+        messages_path,
+        pid,
+        sidecar_socket_file,
+        knowledge_source=None,
+        max_shards=DEFAULT_MAX_SHARDS,
+        wisdom=None,
+        notifier=None,
+        handle_signals=True,
+        event_queue_size=DEFAULT_EVENT_QUEUE_SIZE,
+    ):
         log.debug("Seer instance initializing.")
+        self._asleep = threading.Event()
+        self._event_lock = threading.RLock()
+        self._events = queue.SimpleQueue()
+        self._event_queue_size = event_queue_size
+        self.transition_stats = TransitionStats()
         # The Seer sends notifications to the SUT via the sidecar.
         self._messages_path = messages_path
-        self.notifier = SidecarNotifier(sidecar_socket_file, messages_path)
+        if notifier is None:
+            notifier = SidecarNotifier(sidecar_socket_file, messages_path)
+        self.notifier = notifier
 
         # The location is used for saving and restoring memories.
         self._memories_file = memories_file
-        if os.path.exists(memories_file):
-            log.debug("Memories found. Recalling experiences.")
-            self.wisdom = pickle.load(open(memories_file, "rb"))
-            os.remove(memories_file)
-        else:
-            log.debug("No memories found. Using book knowledge.")
-            self.wisdom = Wisdom()
+        if wisdom is None:
+            # The knowledge always comes from the current arguments.
+            # Memories only bring back the perspective.
+            wisdom = Wisdom(knowledge_source, max_shards)
+            perspective = self._recall_memories()
+            if perspective is None:
+                log.debug("No memories found. Using book knowledge.")
+            else:
+                wisdom.knowledge.refresh()
+                wisdom.recall_perspective(perspective)
+        self.wisdom = wisdom
 
         self.state = Waking(
             notifier=self.notifier,
@@ -84,8 +133,12 @@ class Seer:
         )
         # Supported O/S signals must be mapped to handler functions.
         # The handlers operate on the self.state object.
-        self._register_event_signals(supported_signals)
-        self._register_shutdown_signal(signal.SIGTERM)
+        if handle_signals:
+            threading.Thread(
+                name="Seer events", target=self._process_events, daemon=True
+            ).start()
+            self._register_event_signals(supported_signals)
+            self._register_shutdown_signal(signal.SIGTERM)
 
         # Give the waking seer a nudge to make him available.
         self.event(Event.rally)
@@ -101,7 +154,31 @@ class Seer:
                 application. This object must receive events in order for
                 the application to respond to the event.
         """
-        self.state = self.state.on_event(event)
+        # Events arrive from signals and from REST requests.
+        with self._event_lock:
+            self.state = self.state.on_event(event)
+
+    def apply_events(self, events):
+        """Send a batch of events to the state machine, in order. Events
+        from signals wait until the whole batch has been applied.
+
+        Args:
+            events (list): The Event's to apply.
+        """
+        with self._event_lock:
+            for event in events:
+                self.event(event)
+
+    def wait_until_asleep(self, timeout=None):
+        """Wait for a shutdown signal to be fully processed.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            bool: Whether or not the seer is asleep.
+        """
+        return self._asleep.wait(timeout)
 
     def _register_event_signals(self, signals):
         # Associate signals with the a signal handler that
@@ -134,40 +211,179 @@ class Seer:
         self._service_interface_shutdown = service_interface_shutdown
 
     def _handle_event_signal(self, signum, sigstack):
-        """This signal handler processes asynchronous events by translating
-        the O/S signal events to application events and then sending the
-        events to the seer state machine.
+        """This signal handler queues asynchronous events by translating
+        the O/S signal events to application events. The event thread
+        sends the events to the seer state machine.
         """
-        log.debug(
-            "signal handling requested: "
-            f"{sig_num_to_name[signum]} ({signum})"
-        )
         if signum in sign_num_to_event.keys():
-            event = sign_num_to_event[signum]
-            self.event(event)
-            log.debug(
-                "signal handling performed: "
-                f"{sig_num_to_name[signum]} ({signum})"
-            )
+            self._queue_event(sign_num_to_event[signum], signum)
 
     def _handle_shutdown_signal(self, signum, sigstack):
-        """This signal handler performs a series of operations that:
+        """This signal handler queues a shutdown. See _shut_down()."""
+        self._queue_event(_SHUTDOWN, signum)
+
+    def _queue_event(self, event, signum):
+        # Only queue operations are safe here. See SimpleQueue.put.
+        # A shutdown is never dropped, however busy the seer is.
+        full = self._events.qsize() >= self._event_queue_size
+        if full and event is not _SHUTDOWN:
+            self.transition_stats.dropped += 1
+            return
+        self._events.put((event, signum, time.monotonic()))
+
+    def _process_events(self):
+        """Process queued events in order, in the event thread."""
+        while True:
+            # Wait for an event, then take whatever else arrived with it.
+            pending = [self._events.get()]
+            while True:
+                try:
+                    pending.append(self._events.get_nowait())
+                except queue.Empty:
+                    break
+
+            batch = _coalesce(pending)
+            self.transition_stats.coalesced += len(pending) - len(batch)
+            for event, signum, queued_at in batch:
+                log.debug(
+                    "signal handling requested: "
+                    f"{sig_num_to_name[signum]} ({signum})"
+                )
+                if event is _SHUTDOWN:
+                    try:
+                        self._shut_down(signum)
+                    except Exception:
+                        log.exception("The seer did not shut down cleanly.")
+                    # Nothing is left to do for a sleeping seer.
+                    return
+
+                # One failed transition must not stop the seer from
+                # handling the signals that follow, SIGTERM above all.
+                try:
+                    self.event(event)
+                except Exception:
+                    log.exception(
+                        f"The seer could not {event.value} while "
+                        f"{self.state}."
+                    )
+                self.transition_stats.record(time.monotonic() - queued_at)
+                log.debug(
+                    "signal handling performed: "
+                    f"{sig_num_to_name[signum]} ({signum})"
+                )
+
+    def _shut_down(self, signum):
+        """This method performs a series of operations that:
         * Preserve the current knowledge and perspective of the seer.
         * Shut down the REST interface.
         * Update the seer state machine.
+
+        Memories are saved while the REST interface drains.
         """
-        log.debug(f"_handle_shutdown_signal({signum})")
+        log.debug(f"_shut_down({signum})")
 
-        log.info("Saving memories.")
-        pickle.dump(self.wisdom, open(self._memories_file, "wb"))
-        self.event(Event.sleep)
+        saving = threading.Thread(
+            name="Saving memories", target=self._save_memories
+        )
+        saving.start()
 
         try:
-            self._service_interface_shutdown()
-        except AttributeError:
-            # A shutdown signal was received
-            # before the app service register its shutdown function.
-            pass
+            try:
+                self._service_interface_shutdown()
+            except AttributeError:
+                # A shutdown signal was received
+                # before the app service register its shutdown function.
+                pass
+
+            self.event(Event.sleep)
+        finally:
+            # The main thread waits for this, whatever went wrong.
+            saving.join()
+            self._asleep.set()
+
+    def _recall_memories(self):
+        """Recall the perspective saved at the last shutdown. Memories are
+        recalled once, so the file is removed whether or not they could
+        be made sense of.
+
+        Returns:
+            str: The recalled perspective, or None if there are no usable
+                memories.
+        """
+        if not os.path.exists(self._memories_file):
+            return None
+
+        log.debug("Memories found. Recalling experiences.")
+        try:
+            with open(self._memories_file, "rb") as fp:
+                return pickle.load(fp).perspective
+        except Exception as e:
+            # E.g. memories from an older seer, or of knowledge that is
+            # no longer where it was.
+            log.error(f"Could not recall memories: {e!r}")
+            return None
+        finally:
+            os.remove(self._memories_file)
+
+    def _save_memories(self):
+        log.info("Saving memories.")
+        started = time.monotonic()
+        with open(self._memories_file, "wb") as fp:
+            pickle.dump(self.wisdom, fp)
+        log.info(
+            f"Memories saved in {time.monotonic() - started:.3f} seconds."
+        )
+
+
+class TransitionStats:
+    """How long events queued by signals wait to be processed, in seconds.
+
+    Attributes:
+        count (int): The number of events processed.
+        coalesced (int): The number of events that repeated the event
+            before them and were not processed separately.
+        dropped (int): The number of events dropped because the queue
+            was full.
+        last (float): The latency of the last event.
+        max (float): The greatest latency.
+        total (float): The sum of the latencies.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+
+    def record(self, latency):
+        self.count += 1
+        self.last = latency
+        self.max = max(self.max, latency)
+        self.total += latency
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "last": self.last,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else 0.0,
+        }
+
+
+def _coalesce(pending):
+    # Repeats of the same event in a row are processed once, at the
+    # latency of the first of them. Shutdowns are never folded away.
+    coalesced = []
+    for item in pending:
+        event = item[0]
+        if event is not _SHUTDOWN and coalesced and coalesced[-1][0] is event:
+            continue
+        coalesced.append(item)
+    return coalesced
 
 
 class State:
@@ -176,6 +392,9 @@ class State:
     individual states within the state machine.
     """
 
+    # A new State is made at each transition. Subclasses add no attributes.
+    __slots__ = ("config",)
+
     def __init__(self, **config):
         # The config-as-a-dictionary keeps initialization code neat.
         try:
@@ -211,6 +430,8 @@ class Available(State):
     questions while Available. The sidecar is notified that the app is ready.
     """
 
+    __slots__ = ()
+
     def __init__(self, **config):
         log.debug("Seer.State transitioned to Available.")
         super().__init__(**config)
@@ -253,6 +474,8 @@ class Napping(State):
     can sleep-learn. The sidecar is notified that the app is not ready.
     """
 
+    __slots__ = ()
+
     def __init__(self, **config):
         log.info("Seer.State transitioned to Napping.")
         super().__init__(**config)
@@ -286,6 +509,8 @@ class Sleeping(State):
     The sidecar is notified that the app is no longer ready.
     """
 
+    __slots__ = ()
+
     def __init__(self, **config):
         log.debug("Seer.State transitioned to Sleeping.")
         super().__init__(**config)
@@ -302,6 +527,8 @@ class Waking(State):
     knowledge. The sidecar is notified that a unidentified seer is stirring.
     """
 
+    __slots__ = ()
+
     def __init__(self, **config):
         log.debug("Seer.State transitioned to Waking.")
         super().__init__(**config)
@@ -167,3 +167,19 @@ class SidecarNotifier:
     @property
     def has_pending_injections(self):
         return os.path.exists(self._message_file_path)
+
+
+class QuietNotifier:
+    """A stand-in for SidecarNotifier for seers that have no sidecar,
+    e.g. the seers in a SeerPool. Notifications go nowhere.
+    """
+
+    def send_injected_messages(self):
+        return False, 0
+
+    def send_ready_update(self, ready=False, pid=0):
+        return True
+
+    @property
+    def has_pending_injections(self):
+        return False
@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from random import random
+
+from demoapp.configuredlogger import SeerLogger
+
+log = SeerLogger(__name__, import_level=True)
+
+"""Where does the time go when the seer is slow to answer?
+
+A Tracer samples a fraction of the REST requests. For each sampled request,
+a Trace records one span per stage of the request: waiting to be picked up
+after the socket accept, reading and parsing the request, routing, checking
+the seer's state, sampling an answer, encoding it and writing it.
+
+Finished traces wait in a ring buffer. A background thread periodically
+writes them to a file in the OpenTelemetry (OTLP) JSON format, one export
+request per line, so that any OTLP-aware tool can pick them up. When the
+buffer fills faster than it is written, the oldest traces are dropped.
+
+When tracing is off, or a request is not sampled, a request costs no more
+than a few checks for None.
+"""
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_BUFFER_SIZE = 1024
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+# OTLP span kinds.
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+
+
+class Trace:
+    """The spans of a single request.
+
+    Args:
+        name (str): The name of the root span.
+        start_ns (int): When the request started, in nanoseconds since
+            the epoch.
+    """
+
+    __slots__ = ("name", "start_ns", "end_ns", "attributes", "_marks")
+
+    def __init__(self, name, start_ns):
+        self.name = name
+        self.start_ns = start_ns
+        self.end_ns = None
+        self.attributes = {}
+        self._marks = [("", start_ns)]
+
+    def mark(self, stage):
+        """End the current stage. The stage is recorded as a span that
+        started where the previous stage ended.
+
+        Args:
+            stage (str): The name of the stage that just ended.
+        """
+        self._marks.append((stage, time.time_ns()))
+
+    def to_otlp(self):
+        """Convert the trace to OTLP JSON spans.
+
+        Returns:
+            list: The root span followed by a span for each stage.
+        """
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+        spans = [
+            _span(
+                trace_id,
+                root_id,
+                None,
+                self.name,
+                SPAN_KIND_SERVER,
+                self.start_ns,
+                self.end_ns,
+                self.attributes,
+            )
+        ]
+        for (_, start_ns), (stage, end_ns) in zip(
+            self._marks, self._marks[1:]
+        ):
+            spans.append(
+                _span(
+                    trace_id,
+                    os.urandom(8).hex(),
+                    root_id,
+                    stage,
+                    SPAN_KIND_INTERNAL,
+                    start_ns,
+                    end_ns,
+                )
+            )
+        return spans
+
+
+class Tracer:
+    """Samples requests for tracing and writes the traces to a file.
+
+    Args:
+        output_file (str): The file to which traces are appended.
+        sample_rate (float): The fraction of requests to trace, from 0 to 1.
+        buffer_size (int): The number of finished traces to hold until they
+            are written.
+        flush_interval (float): Seconds between writes.
+    """
+
+    def __init__(
+        self,
+        output_file,
+        sample_rate=DEFAULT_SAMPLE_RATE,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+    ):
+        self._output_file = output_file
+        self._sample_rate = sample_rate
+        self._finished = deque(maxlen=buffer_size)
+        self._flush_interval = flush_interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def begin(self, name, start_ns=None):
+        """Start a trace, if this request is sampled.
+
+        Args:
+            name (str): The name of the root span.
+            start_ns (int): When the request started, in nanoseconds since
+                the epoch. Defaults to now.
+
+        Returns:
+            Trace: The new trace, or None if the request is not sampled.
+        """
+        if random() >= self._sample_rate:
+            return None
+        return Trace(name, start_ns or time.time_ns())
+
+    def finish(self, trace):
+        """End a trace and queue it to be written."""
+        trace.end_ns = time.time_ns()
+        self._finished.append(trace)
+
+    def start(self):
+        """Start writing traces in a daemon thread."""
+        self._thread = threading.Thread(
+            name="Trace writer", target=self._write_periodically, daemon=True
+        )
+        self._thread.start()
+        log.info(
+            f"Tracing {self._sample_rate:.1%} of requests "
+            f"to {self._output_file}"
+        )
+
+    def stop(self):
+        """Stop the writer thread and write the remaining traces."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def flush(self):
+        """Write the finished traces to the output file."""
+        spans = []
+        while self._finished:
+            spans.extend(self._finished.popleft().to_otlp())
+        if not spans:
+            return
+
+        export = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": _attributes(
+                            {"service.name": "demoapp"}
+                        )
+                    },
+                    "scopeSpans": [
+                        {"scope": {"name": __name__}, "spans": spans}
+                    ],
+                }
+            ]
+        }
+        try:
+            with open(self._output_file, "a") as fp:
+                fp.write(json.dumps(export) + "\n")
+        except OSError as e:
+            log.error(f"Could not write traces to {self._output_file}: {e}")
+
+    def _write_periodically(self):
+        while not self._stopping.wait(self._flush_interval):
+            self.flush()
+
+
+def _span(
+    trace_id, span_id, parent_id, name, kind, start_ns, end_ns, attributes=None
+):
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": kind,
+        # OTLP JSON encodes 64-bit integers as strings.
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    if attributes:
+        span["attributes"] = _attributes(attributes)
+    return span
+
+
+def _attributes(attributes):
+    encoded = []
+    for key, value in attributes.items():
+        if isinstance(value, int):
+            encoded.append({"key": key, "value": {"intValue": str(value)}})
+        else:
+            encoded.append({"key": key, "value": {"stringValue": str(value)}})
+    return encoded
@@ -1,11 +1,21 @@
-import yaml
+import threading
+from collections import namedtuple
 from random import randrange
-from pkg_resources import resource_stream
 
 from demoapp.configuredlogger import SeerLogger
+from demoapp.knowledge import DEFAULT_MAX_SHARDS, KnowledgeStore
 
 log = SeerLogger(__name__, import_level=True)
 
+# The perspective a seer has taken up, and the knowledge generation it was
+# taken from. It is replaced as a whole, so readers never see a mix of two.
+_ActivePerspective = namedtuple(
+    "_ActivePerspective",
+    ("generation", "idx", "name", "answers", "encoded_answers"),
+)
+
+_NO_PERSPECTIVE = _ActivePerspective(None, None, None, (), ())
+
 
 class Wisdom:
     """In this application that emulates the famous "Magic 8-Ball" toy,
@@ -22,12 +32,31 @@ class Wisdom:
 
     This class handles helps the seer to learn and to organize his answers
     according to perspectives.
+
+    Args:
+        knowledge_source (str or list): A knowledge file, a directory of
+            knowledge shards, or a list of either. See KnowledgeStore.
+            The knowledge file included in this module's package is used
+            by default.
+        max_shards (int): The number of knowledge shards to keep compiled.
+        knowledge (KnowledgeStore): Compiled knowledge to share with other
+            seers. If given, knowledge_source and max_shards are ignored.
     """
 
-    def __init__(self):
-        self._answers = []
-        self._perspective_idx = None
-        self._wisdom = None
+    __slots__ = ("_active", "_knowledge", "_lock")
+
+    def __init__(
+        self,
+        knowledge_source=None,
+        max_shards=DEFAULT_MAX_SHARDS,
+        knowledge=None,
+    ):
+        if knowledge is None:
+            knowledge = KnowledgeStore(knowledge_source, max_shards)
+        self._active = _NO_PERSPECTIVE
+        self._knowledge = knowledge
+        # Serializes changes of perspective. Readers don't need it.
+        self._lock = threading.Lock()
 
     def acquire_knowledge(self):
         """The seer is brought to drink at the fount of knowledge.
@@ -39,52 +68,156 @@ class Wisdom:
         he tries a new perspective.
         """
 
-        # A knowledge file is included in this module's package.
-        # So, the location is known.
-        stream = resource_stream("demoapp", "data/knowledge.yaml")
-        self._wisdom = yaml.load(stream, Loader=yaml.SafeLoader)
+        # Only perspectives that changed since the last visit are re-read.
+        try:
+            self._knowledge.refresh()
+        except Exception as e:
+            if not self._knowledge:
+                raise
+            # E.g. a knowledge file caught in the middle of an edit.
+            log.error(f"Could not refresh knowledge. Keeping it as is: {e}")
         log.debug(f"The seer aquired knowledge.")
         self._update_perspective()
 
     def answer_question(self):
-        return self._answers[randrange(0, len(self._answers))]
+        answers = self._current().answers
+        return answers[randrange(0, len(answers))]
+
+    def encoded_answer(self):
+        """Like answer_question, but the answer is already JSON-encoded.
+
+        Returns:
+            bytes: The encoded answer.
+        """
+        answers = self._current().encoded_answers
+        return answers[randrange(0, len(answers))]
+
+    def recall_perspective(self, name=None):
+        """Take up a perspective without drinking from the fount of
+        knowledge again. The knowledge must already have been acquired,
+        e.g. by another seer that shares it.
 
-    def _get_new_perspective(self):
+        Args:
+            name (str): The perspective to take up. The first perspective is
+                used if there is no such perspective.
+        """
+        with self._lock:
+            idx = self._knowledge.index_of(name)
+            self._activate_perspective(0 if idx is None else idx)
+
+    def _current(self):
+        # Other threads may swap the active perspective. Only look once.
+        active = self._active
+        if active.generation != self._knowledge.generation:
+            active = self._follow_knowledge()
+        return active
+
+    def _follow_knowledge(self):
+        # The knowledge changed underneath the seer, e.g. the knowledge file
+        # was edited. Keep the same perspective if it is still around.
+        with self._lock:
+            active = self._active
+            if active.generation == self._knowledge.generation:
+                # Another thread followed, or changed perspective, first.
+                return active
+            if not self._knowledge:
+                # Nothing to follow. Keep the answers the seer already has.
+                self._active = active._replace(
+                    generation=self._knowledge.generation
+                )
+                return self._active
+
+            idx = self._knowledge.index_of(active.name)
+            if idx is None:
+                log.info(
+                    f"Perspective {active.name} was forgotten. "
+                    "Returning to the first perspective."
+                )
+                idx = 0
+            return self._activate_perspective(idx)
+
+    def _get_new_perspective(self, idx):
         new_idx = 0
-        num_of_perspectives = len(self._wisdom)
+        num_of_perspectives = len(self._knowledge)
         log.debug(f"The seer has {num_of_perspectives} perspectives.")
         if num_of_perspectives > 1:
-            new_idx = self._perspective_idx
+            new_idx = idx
             # Don't use the same perspective again.
-            while new_idx == self._perspective_idx:
-                # _wisdom is a list of perspectives
+            while new_idx == idx:
+                # _knowledge is a list of perspectives
                 new_idx = randrange(0, num_of_perspectives)
 
         return new_idx
 
     def _update_perspective(self):
-        if self._perspective_idx is None:
-            # Only None at object initialization.
-            # The first perspective is the startup default.
-            self._perspective_idx = 0
-        else:
-            self._perspective_idx = self._get_new_perspective()
-
-        self._answers = self._wisdom[self._perspective_idx]["answers"]
+        with self._lock:
+            idx = self._active.idx
+            if idx is None:
+                # Only None at object initialization.
+                # The first perspective is the startup default.
+                idx = 0
+            else:
+                idx = self._get_new_perspective(idx)
+            active = self._activate_perspective(idx)
         log.debug(
-            f"Updated answers for: perspective = {self.perspective}, "
-            f"perspective_idx: {self._perspective_idx}"
+            f"Updated answers for: perspective = {active.name}, "
+            f"perspective_idx: {active.idx}"
+        )
+
+    def _activate_perspective(self, idx):
+        # Called with the lock held.
+        while True:
+            generation = self._knowledge.generation
+            try:
+                perspective = self._knowledge[idx]
+                break
+            except ValueError as e:
+                # The perspective's shard does not hold it. The store has
+                # dropped it from the index. Take up the next one instead.
+                log.error(f"Could not take up perspective {idx}: {e}")
+                if not self._knowledge:
+                    self._active = self._active._replace(
+                        generation=self._knowledge.generation
+                    )
+                    return self._active
+                idx = min(idx, len(self._knowledge) - 1)
+        # Encode once now, rather than once per question.
+        self._active = _ActivePerspective(
+            generation,
+            idx,
+            perspective.name,
+            perspective.answers,
+            perspective.encoded_answers,
         )
+        return self._active
+
+    @property
+    def knowledge(self):
+        """KnowledgeStore: The compiled knowledge the seer learns from."""
+        return self._knowledge
 
     @property
     def perspective(self):
-        return self._wisdom[self._perspective_idx]["perspective"]
+        return self._current().name
 
     @property
     def perspective_index(self):
-        return self._perspective_idx
+        return self._current().idx
 
     @property
     def is_meager(self):
         # The seer's level of knowledge.
-        return not bool(self._wisdom)
+        return self._active.idx is None or not bool(self._knowledge)
+
+    def __getstate__(self):
+        # Memories only hold the perspective. The knowledge is learned
+        # again from wherever the seer is told to learn from now.
+        return {"perspective": self.perspective}
+
+    def __setstate__(self, state):
+        # Recalled, but not yet learned. See Seer._recall_memories.
+        self.__init__()
+        self._active = _NO_PERSPECTIVE._replace(
+            generation=self._knowledge.generation,
+            name=state["perspective"],
+        )
@@ -20,7 +20,7 @@ setup(
     author="The mobius team at MATRIX/RAS",
     author_email="svteng_team_mobius@matrix.com",
     url="https://artifactory.rspringob.local/artifactory/pypi-virtual/demoapp",
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     packages=["demoapp"],
     package_dir={"demoapp": "demoapp"},
     package_data={"demoapp": ["data/*.yaml"]},